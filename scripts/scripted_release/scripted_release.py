@@ -11,9 +11,15 @@ from scripted_release_utils import (
     increment_release_candidate_tag,
     ReleaseLog,
     drop_release_candidate_string,
-    is_valid_commit_hash,
+    parse_commit_tokens,
+    resolve_commit_tokens,
     cherry_pick_commits,
-    delete_branch
+    delete_branch,
+    list_remote_release_refs,
+    select_refs_to_prune,
+    archive_and_delete_refs,
+    RELEASE_ARCHIVE_BRANCH,
+    RELEASE_ARCHIVE_MANIFEST
 )
 
 load_dotenv()
@@ -28,6 +34,7 @@ class ReleaseAction(Enum):
     UPDATE_RELEASE = "Update release"
     FINALIZE_RELEASE = "Finalize release"
     HOTFIX = "Hotfix"
+    PRUNE_RELEASES = "Prune releases"
 
 
 # Setup GitHub API instance and retrieve repo
@@ -110,18 +117,9 @@ def update_release():
     incremented_tag = increment_release_candidate_tag(latest_tag.name)
 
     if commit_hashes_input:
-        # List of inputted commit hashes
-        commit_hashes = [
-            commit_hash.strip() for commit_hash in commit_hashes_input.split(",")
-        ]
-        # List of invalid commit hashes
-        invalid_hashes = [
-            commit_hash
-            for commit_hash in commit_hashes
-            if not is_valid_commit_hash(commit_hash, repo)
-        ]
-        if invalid_hashes:
-            raise ValueError(f"Invalid commit hashes provided: {invalid_hashes}")
+        # Resolve PR numbers, short SHAs and ranges into a deduplicated list of full commit hashes. The workflow
+        # checks out full history (fetch-depth: 0), so this resolves against the local clone without fetching
+        commit_hashes = resolve_commit_tokens(parse_commit_tokens(commit_hashes_input), repo)
 
         temp_branch_name = None
         try:
@@ -218,6 +216,39 @@ def hotfix():
     pass
 
 
+def get_retention_count(env_variable, default):
+    """
+    Reads a keep-last-N retention count from the environment, falling back to the default when unset.
+    """
+    value = os.getenv(env_variable) or default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{env_variable} must be a whole number, got '{value}'. Action aborted.")
+
+
+def prune_releases():
+    # Retention policy. Ex: keep the last 3 RC tags of each active version and the last 5 release branches
+    keep_rc_tags = get_retention_count("KEEP_RC_TAGS", 3)
+    keep_release_branches = get_retention_count("KEEP_RELEASE_BRANCHES", 5)
+
+    remote_refs = list_remote_release_refs(RELEASE_NAME)
+    refs_to_prune = select_refs_to_prune(remote_refs, RELEASE_NAME, keep_rc_tags, keep_release_branches, repo)
+    if not refs_to_prune:
+        release_logger.append_release_line("✅ Nothing to prune")
+        return
+
+    archive_and_delete_refs(
+        RELEASE_NAME, refs_to_prune, remote_refs.get(f"refs/heads/{RELEASE_ARCHIVE_BRANCH}")
+    )
+
+    pruned_tag_count = sum(ref.startswith("refs/tags/") for ref in refs_to_prune)
+    release_logger.append_release_line(
+        f"🧹 **Pruned {pruned_tag_count} RC tags and {len(refs_to_prune) - pruned_tag_count} release branches.** "
+        f"Archived in {repo.html_url}/blob/{RELEASE_ARCHIVE_BRANCH}/{RELEASE_ARCHIVE_MANIFEST}"
+    )
+
+
 release_action = os.getenv("RELEASE_ACTION")
 
 release_logger.append_release_line(
@@ -232,5 +263,7 @@ elif release_action == ReleaseAction.FINALIZE_RELEASE.value:
     finalize_release()
 elif release_action == ReleaseAction.HOTFIX.value:
     hotfix()
+elif release_action == ReleaseAction.PRUNE_RELEASES.value:
+    prune_releases()
 else:
     raise ValueError("No release action selected. Action aborted.")
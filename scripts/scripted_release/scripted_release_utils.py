@@ -1,10 +1,11 @@
 # -*- coding: utf-8 -*-
+import json
 import re
 import subprocess
 
 from enum import Enum
 
-from github import GithubException
+from github import UnknownObjectException
 from github.Repository import Repository
 from packaging import version
 
@@ -174,15 +175,238 @@ def drop_release_candidate_string(latest_tag):
     )
 
 
-def is_valid_commit_hash(commit_hash, repo):
+# Matches a pull request token in the COMMIT_HASHES input. Ex: "#123"
+PULL_REQUEST_TOKEN_PATTERN = re.compile(r"#(\d+)")
+
+# Matches a short or full commit SHA, the only revisions accepted on their own or as either end of a range
+COMMIT_SHA_PATTERN = re.compile(r"[0-9a-fA-F]{4,40}")
+
+# Separates the two ends of a commit range token in the COMMIT_HASHES input. Ex: "abc123..def456"
+COMMIT_RANGE_SEPARATOR = ".."
+
+# Fields fetched for each pull request in the batched GraphQL lookup
+PULL_REQUEST_QUERY_FIELDS = "merged mergeCommit { oid } commits(last: 100) { totalCount nodes { commit { message } } }"
+
+
+def parse_commit_tokens(commit_hashes_input):
+    """
+    Splits the COMMIT_HASHES input into individual tokens. Tokens may be separated by commas and/or whitespace.
+
+    Example input:
+    `#123, 1a2b3c4, 5d6e7f8..9a0b1c2`
+
+    Example output:
+    `['#123', '1a2b3c4', '5d6e7f8..9a0b1c2']`
+    """
+    return [token for token in re.split(r"[,\s]+", commit_hashes_input.strip()) if token]
+
+
+def batch_resolve_revisions(revisions):
+    """
+    Resolves short SHAs to full commit SHAs with a single local `git cat-file --batch-check` pass.
+    Returns a dict of revision -> full SHA, or None if the revision does not name a commit in the local clone.
+    """
+    if not revisions:
+        return {}
+
+    output = run_git_output(
+        ["git", "cat-file", "--batch-check=%(objectname) %(objecttype)"],
+        "".join(f"{revision}^{{commit}}\n" for revision in revisions),
+    )
+
+    # cat-file answers each input line with exactly one output line, in order
+    resolved = {}
+    for revision, line in zip(revisions, output.splitlines()):
+        object_name, _, object_type = line.partition(" ")
+        resolved[revision] = object_name if object_type == "commit" else None
+    return resolved
+
+
+def list_commits_in_range(commit_range):
     """
-    Checks if a commit hash is valid by attempting to retrieve it from the repository.
+    Lists the full SHAs of the non-merge commits in a git range, oldest first, so they can be cherry-picked
+    in order. Merge commits are skipped because `git cherry-pick` cannot apply them without `-m`.
+    Returns None if the range cannot be resolved or contains no commits.
     """
     try:
-        repo.get_commit(commit_hash)
-        return True
-    except GithubException:
-        return False
+        output = run_git_output(["git", "rev-list", "--reverse", "--no-merges", commit_range])
+    except subprocess.CalledProcessError:
+        return None
+    return output.split() or None
+
+
+def expand_commit_range(commit_range):
+    """
+    Expands a `a..b` range of commit SHAs into the commits reachable from b but not a, oldest first.
+    Returns None if either end is not a commit SHA, or if the range is empty (ex: the ends are reversed).
+    """
+    range_start, _, range_end = commit_range.partition(COMMIT_RANGE_SEPARATOR)
+    if not (COMMIT_SHA_PATTERN.fullmatch(range_start) and COMMIT_SHA_PATTERN.fullmatch(range_end)):
+        return None
+    return list_commits_in_range(f"{range_start}{COMMIT_RANGE_SEPARATOR}{range_end}")
+
+
+def get_commit_subject(message):
+    """
+    Returns the subject of a commit message the way `git log --format=%s` prints it.
+    """
+    return " ".join(message.strip().split("\n\n", 1)[0].splitlines())
+
+
+def fetch_pull_requests(pull_numbers, repo: Repository):
+    """
+    Looks up several pull requests with a single GraphQL query, one aliased `pullRequest` field per number.
+    Returns a dict of pull number -> pull request data, or None if the pull request does not exist.
+    """
+    if not pull_numbers:
+        return {}
+
+    owner, name = repo.full_name.split("/", 1)
+    aliases = " ".join(
+        f"pr{pull_number}: pullRequest(number: {pull_number}) {{ {PULL_REQUEST_QUERY_FIELDS} }}"
+        for pull_number in pull_numbers
+    )
+    query = f"query($owner: String!, $name: String!) {{ repository(owner: $owner, name: $name) {{ {aliases} }} }}"
+
+    # Missing pull requests come back as null fields plus an error entry, so the raw request is used
+    # instead of graphql_query, which raises on any error and would lose the pull requests that did resolve
+    _, response = repo.requester.requestJsonAndCheck(
+        "POST",
+        repo.requester.graphql_url,
+        input={"query": query, "variables": {"owner": owner, "name": name}},
+    )
+    repository = (response.get("data") or {}).get("repository") or {}
+    return {pull_number: repository.get(f"pr{pull_number}") for pull_number in pull_numbers}
+
+
+def batch_get_commit_parents(commit_shas):
+    """
+    Looks up the parents of several commits with a single local `git rev-list` pass.
+    Returns a dict of commit SHA -> list of parent SHAs. Commits missing from the local clone are left out.
+    """
+    if not commit_shas:
+        return {}
+
+    output = run_git_output(
+        ["git", "rev-list", "--no-walk=unsorted", "--parents", "--ignore-missing", "--stdin"],
+        "".join(f"{commit_sha}\n" for commit_sha in commit_shas),
+    )
+    return {commit_sha: parents for commit_sha, *parents in (line.split() for line in output.splitlines())}
+
+
+def get_landed_commits(merge_commit_sha, parents, pull_request_commits):
+    """
+    Returns the full SHAs a merged pull request landed with, oldest first, or None if its merge commit
+    is not in the local clone.
+
+    - Squash merge: the single squashed commit
+    - Merge commit: the non-merge commits the merge brought in, not the merge itself
+    - Rebase merge: every rebased commit, detected by the last N commits matching the PR's commit subjects
+    """
+    if parents is None:
+        return None
+    if len(parents) > 1:
+        return list_commits_in_range(f"{merge_commit_sha}^1..{merge_commit_sha}")
+
+    commit_count = pull_request_commits["totalCount"]
+    if commit_count > 1:
+        pull_request_subjects = [
+            get_commit_subject(node["commit"]["message"]) for node in pull_request_commits["nodes"]
+        ]
+        try:
+            landed_subjects = run_git_output(
+                ["git", "log", "--format=%s", "-n", str(len(pull_request_subjects)), merge_commit_sha]
+            ).splitlines()[::-1]
+        except subprocess.CalledProcessError:
+            return None
+        if landed_subjects == pull_request_subjects:
+            return list_commits_in_range(f"{merge_commit_sha}~{commit_count}..{merge_commit_sha}")
+
+    return [merge_commit_sha]
+
+
+def resolve_pull_request_commits(pull_numbers, repo: Repository):
+    """
+    Resolves several pull request numbers to the commits they landed with, using one GraphQL query and one
+    local git pass for all of them. Returns a dict of pull number -> list of full SHAs, or None if the pull
+    request does not exist, is not merged, or its merge commit is not in the local clone.
+    """
+    pull_requests = fetch_pull_requests(pull_numbers, repo)
+    merge_commits = {
+        pull_number: pull_request["mergeCommit"]["oid"]
+        for pull_number, pull_request in pull_requests.items()
+        if pull_request and pull_request["merged"] and pull_request["mergeCommit"]
+    }
+    parents_by_commit = batch_get_commit_parents(list(merge_commits.values()))
+
+    resolved = dict.fromkeys(pull_numbers)
+    for pull_number, merge_commit_sha in merge_commits.items():
+        resolved[pull_number] = get_landed_commits(
+            merge_commit_sha, parents_by_commit.get(merge_commit_sha), pull_requests[pull_number]["commits"]
+        )
+    return resolved
+
+
+def resolve_commit_tokens(tokens, repo: Repository):
+    """
+    Resolves a mix of pull request numbers, short/full SHAs and commit ranges into a deduplicated
+    list of full commit SHAs, preserving input order.
+
+    - `#123` resolves to the commits pull request 123 landed with
+    - `1a2b3c4` resolves to the full SHA of that commit
+    - `1a2b3c4..5d6e7f8` expands to every non-merge commit in the range, oldest first
+
+    All pull requests are looked up in one GraphQL query and all SHA tokens in one local git pass,
+    rather than one API call per token. Raises a ValueError for bare numbers (most likely PR numbers
+    missing their `#`), for any tokens that could not be resolved, or if the tokens resolve to no commits at all.
+    """
+    unique_tokens = list(dict.fromkeys(tokens))
+
+    # An all-digit token is valid hex, so a PR number typed without `#` would silently match an unrelated commit
+    bare_numbers = [token for token in unique_tokens if token.isdigit()]
+    if bare_numbers:
+        raise ValueError(
+            f"Ambiguous commit hashes provided: {bare_numbers}. "
+            f"Prefix PR numbers with '#' (ex: '#{bare_numbers[0]}') or use the full commit hash."
+        )
+
+    resolved = {}
+    pull_request_tokens = {}
+    revision_tokens = []
+    for token in unique_tokens:
+        pull_request_match = PULL_REQUEST_TOKEN_PATTERN.fullmatch(token)
+        if pull_request_match:
+            pull_request_tokens[token] = int(pull_request_match.group(1))
+        elif COMMIT_RANGE_SEPARATOR in token:
+            resolved[token] = expand_commit_range(token)
+        elif COMMIT_SHA_PATTERN.fullmatch(token):
+            revision_tokens.append(token)
+        else:
+            resolved[token] = None
+
+    pull_request_commits = resolve_pull_request_commits(list(dict.fromkeys(pull_request_tokens.values())), repo)
+    for token, pull_number in pull_request_tokens.items():
+        resolved[token] = pull_request_commits[pull_number]
+
+    for token, commit_sha in batch_resolve_revisions(revision_tokens).items():
+        resolved[token] = [commit_sha] if commit_sha else None
+
+    invalid_tokens = [token for token in unique_tokens if not resolved.get(token)]
+    if invalid_tokens:
+        raise ValueError(f"Invalid commit hashes provided: {invalid_tokens}")
+
+    # Drop commits that were requested more than once, e.g. a SHA that is also part of a range
+    commit_hashes = list(dict.fromkeys(commit_sha for token in unique_tokens for commit_sha in resolved[token]))
+    if not commit_hashes:
+        raise ValueError("No commits to cherry-pick. Action aborted.")
+    return commit_hashes
+
+
+def run_git_output(args, input_text=None):
+    """
+    Executes a git command given as an argument list (no shell) and returns its stdout. Raises if the command fails.
+    """
+    return subprocess.run(args, input=input_text, capture_output=True, text=True, check=True).stdout
 
 
 def run_git_command(command):
@@ -196,14 +420,20 @@ def run_git_command(command):
         raise
 
 
-def cherry_pick_commits(commit_hashes, branch):
+def configure_git_identity():
     """
-    Checks out the release branch and cherry-picks each commit hash into it.
+    Configures the Git user identity used for commits made by the script.
     """
-    # Configure Git user identity
     run_git_command("git config --global user.name 'GitHub Actions'")
     run_git_command("git config --global user.email 'actions@github.com'")
 
+
+def cherry_pick_commits(commit_hashes, branch):
+    """
+    Checks out the release branch and cherry-picks each commit hash into it.
+    """
+    configure_git_identity()
+
     # Ensure you are on the correct branch
     run_git_command(f"git fetch --all")
     run_git_command(f"git checkout {branch}")
@@ -230,3 +460,218 @@ def delete_branch(branch_name):
     Deletes a branch from the repository. Used to delete the temporary cherrry-pick branch.
     """
     run_git_command(f"git push origin --delete {branch_name}")
+
+
+# Branch holding the manifest of pruned release refs, and the manifest file name on that branch
+RELEASE_ARCHIVE_BRANCH = "release-archive"
+RELEASE_ARCHIVE_MANIFEST = "release_archive.json"
+
+
+def list_remote_release_refs(release_name):
+    """
+    Lists the release tags, release branches and the archive branch on origin with a single
+    `git ls-remote` call. Returns a dict of full ref name -> commit SHA. Annotated tags are peeled to
+    the commit they point at.
+
+    Example output:
+    `{'refs/tags/portal/v1.0.0-rc1': '1a2b...', 'refs/heads/release/portal/v1.0.0': '5d6e...'}`
+    """
+    output = run_git_output(
+        [
+            "git", "ls-remote", "origin",
+            f"refs/tags/{release_name}/*",
+            f"refs/heads/release/{release_name}/*",
+            f"refs/heads/{RELEASE_ARCHIVE_BRANCH}",
+        ]
+    )
+
+    remote_refs = {}
+    for line in output.splitlines():
+        sha, _, ref = line.partition("\t")
+        # The peeled `^{}` entry of an annotated tag follows the tag itself, so the commit SHA replaces the tag object SHA
+        if ref:
+            remote_refs[ref.removesuffix("^{}")] = sha
+    return remote_refs
+
+
+def validate_keep_last(keep_last):
+    """
+    Ensures a keep-last-N retention policy always keeps the latest ref.
+    """
+    if keep_last < 1:
+        raise ValueError(f"Retention policy must keep at least 1 ref, got {keep_last}")
+
+
+def select_superseded_rc_tags(tag_names, release_name, keep_last, active_versions):
+    """
+    Returns the release candidate tags to prune. Finalized (non -rc) tags are never selected.
+
+    - Active versions (ex: `1.1.0`) keep their last `keep_last` RC tags
+    - Every RC tag of an inactive version is selected, except the latest RC tag of the newest version,
+      which Create, Update and Finalize release build on
+
+    Example with keep_last=2 and active_versions={'1.1.0'}:
+    `portal/v1.0.0-rc1`, `portal/v1.0.0-rc2`, `portal/v1.1.0-rc1`, `portal/v1.1.0-rc2`, `portal/v1.1.0-rc3`
+
+    Would return:
+    `['portal/v1.0.0-rc1', 'portal/v1.0.0-rc2', 'portal/v1.1.0-rc1']`
+    """
+    validate_keep_last(keep_last)
+    rc_tag_pattern = re.compile(rf"{re.escape(release_name)}/v(\d+\.\d+\.\d+)-rc(\d+)")
+
+    # Group RC tags by the version they are a candidate for
+    rc_tags_by_version = {}
+    for tag_name in tag_names:
+        match = rc_tag_pattern.fullmatch(tag_name)
+        if match:
+            rc_tags_by_version.setdefault(match.group(1), []).append((int(match.group(2)), tag_name))
+    if not rc_tags_by_version:
+        return []
+
+    newest_version = max(rc_tags_by_version, key=version.parse)
+
+    superseded_tags = []
+    for tag_version, rc_tags in rc_tags_by_version.items():
+        if tag_version in active_versions:
+            kept_count = keep_last
+        else:
+            kept_count = 1 if tag_version == newest_version else 0
+        superseded_tags.extend(tag_name for _, tag_name in sorted(rc_tags)[:len(rc_tags) - kept_count])
+    return sorted(superseded_tags)
+
+
+def select_superseded_release_branches(branch_names, release_name, keep_last):
+    """
+    Returns the release branches to prune, keeping the `keep_last` most recent versions.
+
+    Example with keep_last=2:
+    `release/portal/v1.0.0`, `release/portal/v1.1.0`, `release/portal/v2.0.0`
+
+    Would return:
+    `['release/portal/v1.0.0']`
+    """
+    validate_keep_last(keep_last)
+    branch_name_pattern = re.compile(rf"release/{re.escape(release_name)}/v(\d+\.\d+\.\d+)")
+
+    release_branches = [
+        branch_name for branch_name in branch_names if branch_name_pattern.fullmatch(branch_name)
+    ]
+    release_branches.sort(key=lambda x: version.parse(branch_name_pattern.fullmatch(x).group(1)))
+    return release_branches[:-keep_last]
+
+
+def has_github_release(tag_name, repo: Repository):
+    """
+    Checks if a GitHub release is published for the tag.
+    """
+    try:
+        repo.get_release(tag_name)
+        return True
+    except UnknownObjectException:
+        return False
+
+
+def select_refs_to_prune(remote_refs, release_name, keep_rc_tags, keep_release_branches, repo: Repository):
+    """
+    Applies the retention policies to the refs returned by `list_remote_release_refs` and returns
+    the refs to prune as a dict of full ref name -> commit SHA.
+
+    - Release branches older than the last `keep_release_branches` versions are pruned
+    - A version is active while its release branch is kept and it has no finalized tag. Active versions keep
+      their last `keep_rc_tags` RC tags, plus any RC tag backing a GitHub release (ex: the -rc1 created by
+      Create release)
+    - All RC tags of inactive versions are pruned, except the latest RC tag of the newest version
+    """
+    tag_names = [ref[len("refs/tags/"):] for ref in remote_refs if ref.startswith("refs/tags/")]
+    branch_names = [ref[len("refs/heads/"):] for ref in remote_refs if ref.startswith("refs/heads/release/")]
+
+    superseded_branches = select_superseded_release_branches(branch_names, release_name, keep_release_branches)
+
+    branch_version_pattern = re.compile(rf"release/{re.escape(release_name)}/v(\d+\.\d+\.\d+)")
+    final_tag_pattern = re.compile(rf"{re.escape(release_name)}/v(\d+\.\d+\.\d+)")
+    kept_branch_versions = {
+        match.group(1)
+        for match in (branch_version_pattern.fullmatch(branch_name) for branch_name in branch_names)
+        if match and match.group(0) not in superseded_branches
+    }
+    finalized_versions = {
+        match.group(1) for match in (final_tag_pattern.fullmatch(tag_name) for tag_name in tag_names) if match
+    }
+    active_versions = kept_branch_versions - finalized_versions
+
+    # Only RC tags of active versions are checked for a GitHub release, so the lookups stay bounded by
+    # the active versions rather than growing with every release ever made
+    rc_tag_pattern = re.compile(rf"{re.escape(release_name)}/v(\d+\.\d+\.\d+)-rc\d+")
+    superseded_tags = [
+        tag_name
+        for tag_name in select_superseded_rc_tags(tag_names, release_name, keep_rc_tags, active_versions)
+        if rc_tag_pattern.fullmatch(tag_name).group(1) not in active_versions
+        or not has_github_release(tag_name, repo)
+    ]
+
+    return {
+        ref: remote_refs[ref]
+        for ref in [f"refs/tags/{tag_name}" for tag_name in superseded_tags]
+        + [f"refs/heads/{branch_name}" for branch_name in superseded_branches]
+    }
+
+
+def read_release_archive_manifest(archive_sha):
+    """
+    Returns the manifest stored on the archive branch, or an empty manifest if the branch does not exist yet.
+    The archive branch must already be fetched.
+    """
+    if not archive_sha:
+        return {}
+
+    return json.loads(run_git_output(["git", "show", f"{archive_sha}:{RELEASE_ARCHIVE_MANIFEST}"]))
+
+
+def commit_release_archive_manifest(manifest, archive_sha, archived_commits, message):
+    """
+    Writes the manifest into a new commit on top of the archive branch without touching the working tree.
+    Every archived commit is added as a parent, so the archive branch keeps pruned commits reachable.
+    Returns the new commit SHA.
+    """
+    manifest_json = json.dumps(manifest, indent=1, sort_keys=True) + "\n"
+    blob_sha = run_git_output(["git", "hash-object", "-w", "--stdin"], manifest_json).strip()
+    tree_sha = run_git_output(["git", "mktree"], f"100644 blob {blob_sha}\t{RELEASE_ARCHIVE_MANIFEST}\n").strip()
+
+    parents = list(dict.fromkeys(([archive_sha] if archive_sha else []) + sorted(archived_commits)))
+    parent_args = [arg for parent in parents for arg in ("-p", parent)]
+    return run_git_output(["git", "commit-tree", tree_sha, *parent_args, "-F", "-"], message).strip()
+
+
+def archive_and_delete_refs(release_name, refs_to_prune, archive_sha):
+    """
+    Records the pruned refs and their commit SHAs in the archive manifest, then deletes them from origin.
+    The manifest update and every deletion go out in one atomic push, so either all of them land or none do.
+
+    Manifest format:
+    `{"portal": {"refs/tags/portal/v1.0.0-rc1": "1a2b...", ...}}`
+
+    The archive commit has every pruned commit as a parent, so a pruned ref can always be restored
+    with `git push origin <sha>:<ref>` (tags come back as lightweight tags).
+    """
+    if not refs_to_prune:
+        return
+
+    # A single fetch brings in the current manifest and the commits about to be pruned
+    fetch_refs = sorted(refs_to_prune) + ([f"refs/heads/{RELEASE_ARCHIVE_BRANCH}"] if archive_sha else [])
+    run_git_command(f"git fetch origin {' '.join(fetch_refs)}")
+
+    manifest = read_release_archive_manifest(archive_sha)
+    manifest.setdefault(release_name, {}).update(refs_to_prune)
+
+    configure_git_identity()
+    manifest_commit = commit_release_archive_manifest(
+        manifest,
+        archive_sha,
+        refs_to_prune.values(),
+        f"Archive {len(refs_to_prune)} {release_name} release refs",
+    )
+
+    deletions = " ".join(f":{ref}" for ref in sorted(refs_to_prune))
+    run_git_command(
+        f"git push --atomic origin {manifest_commit}:refs/heads/{RELEASE_ARCHIVE_BRANCH} {deletions}"
+    )
@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
+import json
 import os
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
+
+from github import UnknownObjectException
 
 from scripts.scripted_release.scripted_release_utils import (
     increment_release_tag_and_branch_from_version,
@@ -11,6 +14,18 @@ from scripts.scripted_release.scripted_release_utils import (
     ReleaseLog,
     drop_release_candidate_string,
     increment_release_candidate_tag,
+    parse_commit_tokens,
+    batch_resolve_revisions,
+    expand_commit_range,
+    resolve_pull_request_commits,
+    resolve_commit_tokens,
+    list_remote_release_refs,
+    select_superseded_rc_tags,
+    select_superseded_release_branches,
+    select_refs_to_prune,
+    read_release_archive_manifest,
+    commit_release_archive_manifest,
+    archive_and_delete_refs,
 )
 
 
@@ -192,5 +207,495 @@ class DropReleaseCandidateTag(unittest.TestCase):
         self.assertRaises(ValueError, drop_release_candidate_string, latest_tag)
 
 
+class TestParseCommitTokens(unittest.TestCase):
+    def test_parse_commit_tokens(self):
+        self.assertEqual(
+            parse_commit_tokens(" #123, 1a2b3c4,5d6e7f8..9a0b1c2  abcdef0 "),
+            ["#123", "1a2b3c4", "5d6e7f8..9a0b1c2", "abcdef0"],
+        )
+
+    def test_parse_empty_input(self):
+        self.assertEqual(parse_commit_tokens("  "), [])
+
+
+class TestBatchResolveRevisions(unittest.TestCase):
+    @patch("scripts.scripted_release.scripted_release_utils.run_git_output")
+    def test_batch_resolve_revisions(self, run_git_output):
+        run_git_output.return_value = "1a2b3c4d5e commit\nbeef^{commit} missing\n"
+
+        resolved = batch_resolve_revisions(["1a2b3c4", "beef"])
+
+        self.assertEqual(resolved, {"1a2b3c4": "1a2b3c4d5e", "beef": None})
+        # Both revisions are resolved by a single git invocation
+        run_git_output.assert_called_once()
+        self.assertEqual(run_git_output.call_args[0][1], "1a2b3c4^{commit}\nbeef^{commit}\n")
+
+    @patch("scripts.scripted_release.scripted_release_utils.run_git_output")
+    def test_no_revisions(self, run_git_output):
+        self.assertEqual(batch_resolve_revisions([]), {})
+        run_git_output.assert_not_called()
+
+
+class TestExpandCommitRange(unittest.TestCase):
+    @patch("scripts.scripted_release.scripted_release_utils.run_git_output")
+    def test_expand_commit_range(self, run_git_output):
+        run_git_output.return_value = "sha1\nsha2\n"
+
+        self.assertEqual(expand_commit_range("1a2b3c4..5d6e7f8"), ["sha1", "sha2"])
+        run_git_output.assert_called_once_with(
+            ["git", "rev-list", "--reverse", "--no-merges", "1a2b3c4..5d6e7f8"]
+        )
+
+    @patch("scripts.scripted_release.scripted_release_utils.run_git_output")
+    def test_range_ends_must_be_commit_hashes(self, run_git_output):
+        self.assertIsNone(expand_commit_range("$(touch PWNED)..5d6e7f8"))
+        self.assertIsNone(expand_commit_range("1a2b3c4..HEAD"))
+        self.assertIsNone(expand_commit_range("1a2b3c4..5d6e7f8..9a0b1c2"))
+        run_git_output.assert_not_called()
+
+    @patch("scripts.scripted_release.scripted_release_utils.run_git_output")
+    def test_empty_range_is_invalid(self, run_git_output):
+        run_git_output.return_value = ""
+
+        self.assertIsNone(expand_commit_range("5d6e7f8..1a2b3c4"))
+
+
+def pull_request_data(merge_commit_sha, commit_messages=("Fix bug",), merged=True):
+    return {
+        "merged": merged,
+        "mergeCommit": {"oid": merge_commit_sha} if merged else None,
+        "commits": {
+            "totalCount": len(commit_messages),
+            "nodes": [{"commit": {"message": message}} for message in commit_messages],
+        },
+    }
+
+
+class FakePullRequestGit:
+    """
+    Stands in for run_git_output when resolving pull requests, answering from a fixed commit graph.
+    """
+    def __init__(self, parents, subjects=None, ranges=None):
+        self.parents = parents
+        self.subjects = subjects or {}
+        self.ranges = ranges or {}
+        self.calls = []
+
+    def __call__(self, args, input_text=None):
+        self.calls.append(args)
+        if args[:3] == ["git", "rev-list", "--no-walk=unsorted"]:
+            return "".join(
+                f"{' '.join([sha, *self.parents[sha]])}\n" for sha in input_text.split() if sha in self.parents
+            )
+        if args[:2] == ["git", "log"]:
+            return "".join(f"{subject}\n" for subject in self.subjects[args[-1]])
+        if args[:4] == ["git", "rev-list", "--reverse", "--no-merges"]:
+            return "".join(f"{sha}\n" for sha in self.ranges[args[-1]])
+        raise AssertionError(f"Unexpected git command {args}")
+
+
+class TestResolvePullRequestCommits(unittest.TestCase):
+    def setUp(self):
+        self.repo = MagicMock()
+        self.repo.full_name = "owner/repo"
+
+    def set_pull_requests(self, pull_requests):
+        self.repo.requester.requestJsonAndCheck.return_value = ({}, {"data": {"repository": pull_requests}})
+
+    def test_pull_requests_are_resolved_in_one_batch(self):
+        self.set_pull_requests(
+            {
+                "pr1": pull_request_data("squashsha", ["First", "Second"]),
+                "pr2": pull_request_data("mergesha"),
+                "pr3": None,
+                "pr4": pull_request_data(None, merged=False),
+            }
+        )
+        fake_git = FakePullRequestGit(
+            parents={"squashsha": ["mainsha"], "mergesha": ["mainsha", "branchsha"]},
+            subjects={"squashsha": ["Unrelated", "Squashed (#1)"]},
+            ranges={"mergesha^1..mergesha": ["sha1", "sha2"]},
+        )
+        with patch("scripts.scripted_release.scripted_release_utils.run_git_output", fake_git):
+            resolved = resolve_pull_request_commits([1, 2, 3, 4], self.repo)
+
+        self.assertEqual(resolved, {1: ["squashsha"], 2: ["sha1", "sha2"], 3: None, 4: None})
+        # Every pull request is looked up by one GraphQL query and one local parents pass
+        self.repo.requester.requestJsonAndCheck.assert_called_once()
+        query_input = self.repo.requester.requestJsonAndCheck.call_args.kwargs["input"]
+        for pull_number in [1, 2, 3, 4]:
+            self.assertIn(f"pr{pull_number}: pullRequest(number: {pull_number})", query_input["query"])
+        self.assertEqual(query_input["variables"], {"owner": "owner", "name": "repo"})
+        self.assertEqual(
+            [args for args in fake_git.calls if args[:3] == ["git", "rev-list", "--no-walk=unsorted"]],
+            [["git", "rev-list", "--no-walk=unsorted", "--parents", "--ignore-missing", "--stdin"]],
+        )
+
+    def test_rebase_merge_resolves_to_every_rebased_commit(self):
+        self.set_pull_requests({"pr5": pull_request_data("lastsha", ["First\n\nBody", "Second"])})
+        fake_git = FakePullRequestGit(
+            parents={"lastsha": ["firstsha"]},
+            subjects={"lastsha": ["Second", "First"]},
+            ranges={"lastsha~2..lastsha": ["firstsha", "lastsha"]},
+        )
+        with patch("scripts.scripted_release.scripted_release_utils.run_git_output", fake_git):
+            resolved = resolve_pull_request_commits([5], self.repo)
+
+        self.assertEqual(resolved, {5: ["firstsha", "lastsha"]})
+
+    def test_merge_commit_missing_from_local_clone(self):
+        self.set_pull_requests({"pr6": pull_request_data("unfetchedsha")})
+        fake_git = FakePullRequestGit(parents={})
+        with patch("scripts.scripted_release.scripted_release_utils.run_git_output", fake_git):
+            resolved = resolve_pull_request_commits([6], self.repo)
+
+        self.assertEqual(resolved, {6: None})
+
+    def test_no_pull_requests(self):
+        self.assertEqual(resolve_pull_request_commits([], self.repo), {})
+        self.repo.requester.requestJsonAndCheck.assert_not_called()
+
+
+@patch("scripts.scripted_release.scripted_release_utils.expand_commit_range")
+@patch("scripts.scripted_release.scripted_release_utils.batch_resolve_revisions")
+@patch("scripts.scripted_release.scripted_release_utils.resolve_pull_request_commits")
+class TestResolveCommitTokens(unittest.TestCase):
+    def setUp(self):
+        self.repo = MagicMock()
+
+    def test_resolve_mixed_tokens(self, resolve_pull_request_commits, batch_resolve_revisions, expand_commit_range):
+        resolve_pull_request_commits.return_value = {123: ["pr123sha"], 7: ["pr7sha"]}
+        batch_resolve_revisions.return_value = {"1a2b3c4": "1a2b3c4full"}
+        expand_commit_range.return_value = ["rangesha1", "1a2b3c4full", "rangesha2"]
+
+        commit_hashes = resolve_commit_tokens(
+            ["#123", "1a2b3c4", "aaa..bbb", "#7", "#123", "#007"], self.repo
+        )
+
+        self.assertEqual(commit_hashes, ["pr123sha", "1a2b3c4full", "rangesha1", "rangesha2", "pr7sha"])
+        # All pull requests are resolved together, each number once
+        resolve_pull_request_commits.assert_called_once_with([123, 7], self.repo)
+        batch_resolve_revisions.assert_called_once_with(["1a2b3c4"])
+        expand_commit_range.assert_called_once_with("aaa..bbb")
+
+    def test_bare_number_is_rejected(
+            self, resolve_pull_request_commits, batch_resolve_revisions, expand_commit_range
+    ):
+        with self.assertRaises(ValueError) as context:
+            resolve_commit_tokens(["1a2b3c4", "4521"], self.repo)
+        self.assertIn("['4521']", str(context.exception))
+        self.assertIn("'#4521'", str(context.exception))
+        batch_resolve_revisions.assert_not_called()
+        resolve_pull_request_commits.assert_not_called()
+
+    def test_invalid_tokens(self, resolve_pull_request_commits, batch_resolve_revisions, expand_commit_range):
+        resolve_pull_request_commits.return_value = {999: None}
+        batch_resolve_revisions.return_value = {"beef": None}
+        expand_commit_range.return_value = None
+
+        with self.assertRaises(ValueError) as context:
+            resolve_commit_tokens(["#999", "beef", "aaa..bbb", "beef", "HEAD"], self.repo)
+        # Repeated tokens are reported once, and non-hash revisions never reach git
+        self.assertIn("['#999', 'beef', 'aaa..bbb', 'HEAD']", str(context.exception))
+        batch_resolve_revisions.assert_called_once_with(["beef"])
+
+    def test_token_without_commits_is_invalid(
+            self, resolve_pull_request_commits, batch_resolve_revisions, expand_commit_range
+    ):
+        resolve_pull_request_commits.return_value = {}
+        batch_resolve_revisions.return_value = {}
+        expand_commit_range.return_value = []
+
+        with self.assertRaises(ValueError) as context:
+            resolve_commit_tokens(["aaa..bbb"], self.repo)
+        self.assertIn("['aaa..bbb']", str(context.exception))
+
+    def test_no_commits_to_cherry_pick(
+            self, resolve_pull_request_commits, batch_resolve_revisions, expand_commit_range
+    ):
+        resolve_pull_request_commits.return_value = {}
+        batch_resolve_revisions.return_value = {}
+
+        with self.assertRaises(ValueError) as context:
+            resolve_commit_tokens([], self.repo)
+        self.assertIn("No commits to cherry-pick", str(context.exception))
+
+
+class TestListRemoteReleaseRefs(unittest.TestCase):
+    @patch("scripts.scripted_release.scripted_release_utils.run_git_output")
+    def test_list_remote_release_refs(self, run_git_output):
+        run_git_output.return_value = (
+            "aaa\trefs/heads/release/portal/v1.0.0\n"
+            "bbb\trefs/tags/portal/v1.0.0-rc1\n"
+            "ccc\trefs/tags/portal/v1.0.0-rc1^{}\n"
+            "ddd\trefs/tags/portal/v1.0.0\n"
+        )
+
+        # The annotated tag is recorded by the commit it points at, not the tag object
+        self.assertEqual(
+            list_remote_release_refs("portal"),
+            {
+                "refs/heads/release/portal/v1.0.0": "aaa",
+                "refs/tags/portal/v1.0.0-rc1": "ccc",
+                "refs/tags/portal/v1.0.0": "ddd",
+            },
+        )
+        run_git_output.assert_called_once()
+
+
+class TestSelectSupersededRcTags(unittest.TestCase):
+    def setUp(self):
+        self.tag_names = [
+            "portal/v1.0.0-rc1",
+            "portal/v1.0.0-rc2",
+            "portal/v1.0.0-rc10",
+            "portal/v1.0.0",
+            "portal/v1.1.0-rc1",
+            "other/v1.0.0-rc1",
+        ]
+        self.active_versions = {"1.0.0", "1.1.0"}
+
+    def test_keep_last_rc_tag_per_active_version(self):
+        self.assertEqual(
+            select_superseded_rc_tags(self.tag_names, "portal", 1, self.active_versions),
+            ["portal/v1.0.0-rc1", "portal/v1.0.0-rc2"],
+        )
+
+    def test_keep_last_two_rc_tags_per_active_version(self):
+        self.assertEqual(
+            select_superseded_rc_tags(self.tag_names, "portal", 2, self.active_versions), ["portal/v1.0.0-rc1"]
+        )
+
+    def test_keep_more_than_exist(self):
+        self.assertEqual(select_superseded_rc_tags(self.tag_names, "portal", 50, self.active_versions), [])
+
+    def test_inactive_versions_are_pruned_completely(self):
+        self.assertEqual(
+            select_superseded_rc_tags(self.tag_names, "portal", 50, {"1.1.0"}),
+            ["portal/v1.0.0-rc1", "portal/v1.0.0-rc10", "portal/v1.0.0-rc2"],
+        )
+
+    def test_latest_rc_tag_of_newest_version_is_always_kept(self):
+        self.assertEqual(
+            select_superseded_rc_tags(self.tag_names, "portal", 50, set()),
+            ["portal/v1.0.0-rc1", "portal/v1.0.0-rc10", "portal/v1.0.0-rc2"],
+        )
+
+    def test_no_rc_tags(self):
+        self.assertEqual(select_superseded_rc_tags(["portal/v1.0.0"], "portal", 1, set()), [])
+
+    def test_invalid_keep_last(self):
+        with self.assertRaises(ValueError):
+            select_superseded_rc_tags(self.tag_names, "portal", 0, self.active_versions)
+
+
+class TestSelectRefsToPrune(unittest.TestCase):
+    def setUp(self):
+        self.remote_refs = {
+            # Finalized, branch still kept
+            "refs/heads/release/portal/v1.0.0": "b100",
+            "refs/tags/portal/v1.0.0-rc1": "t100rc1",
+            "refs/tags/portal/v1.0.0-rc2": "t100rc2",
+            "refs/tags/portal/v1.0.0": "t100",
+            # Unfinalized, but its branch falls outside keep_release_branches
+            "refs/heads/release/portal/v0.9.0": "b090",
+            "refs/tags/portal/v0.9.0-rc1": "t090rc1",
+            # Active
+            "refs/heads/release/portal/v1.1.0": "b110",
+            "refs/tags/portal/v1.1.0-rc1": "t110rc1",
+            "refs/tags/portal/v1.1.0-rc2": "t110rc2",
+            "refs/tags/portal/v1.1.0-rc3": "t110rc3",
+            "refs/tags/portal/v1.1.0-rc4": "t110rc4",
+            "refs/heads/release-archive": "archive",
+        }
+        self.repo = MagicMock()
+        # Only the -rc1 of the active version backs a GitHub release
+        self.repo.get_release.side_effect = lambda tag_name: (
+            MagicMock() if tag_name == "portal/v1.1.0-rc1" else self.raise_not_found()
+        )
+
+    @staticmethod
+    def raise_not_found():
+        raise UnknownObjectException(404, "Not Found", None)
+
+    def test_branch_and_rc_tag_policies_combined(self):
+        refs_to_prune = select_refs_to_prune(self.remote_refs, "portal", 2, 2, self.repo)
+
+        self.assertEqual(
+            refs_to_prune,
+            {
+                "refs/tags/portal/v0.9.0-rc1": "t090rc1",
+                "refs/tags/portal/v1.0.0-rc1": "t100rc1",
+                "refs/tags/portal/v1.0.0-rc2": "t100rc2",
+                "refs/tags/portal/v1.1.0-rc2": "t110rc2",
+                "refs/heads/release/portal/v0.9.0": "b090",
+            },
+        )
+        # Releases are only looked up for RC tags of active versions
+        self.assertEqual(
+            [call.args[0] for call in self.repo.get_release.call_args_list],
+            ["portal/v1.1.0-rc1", "portal/v1.1.0-rc2"],
+        )
+
+    def test_newest_version_keeps_its_latest_rc_tag_once_finalized(self):
+        self.remote_refs["refs/tags/portal/v1.1.0"] = "t110"
+
+        refs_to_prune = select_refs_to_prune(self.remote_refs, "portal", 2, 2, self.repo)
+
+        self.assertIn("refs/tags/portal/v1.1.0-rc3", refs_to_prune)
+        self.assertNotIn("refs/tags/portal/v1.1.0-rc4", refs_to_prune)
+        self.repo.get_release.assert_not_called()
+
+
+class TestSelectSupersededReleaseBranches(unittest.TestCase):
+    def setUp(self):
+        self.branch_names = [
+            "release/portal/v10.0.0",
+            "release/portal/v2.0.0",
+            "release/portal/v2.1.0",
+            "release/other/v1.0.0",
+            "feature/portal/new-feature",
+        ]
+
+    def test_keep_last_release_branches(self):
+        self.assertEqual(
+            select_superseded_release_branches(self.branch_names, "portal", 1),
+            ["release/portal/v2.0.0", "release/portal/v2.1.0"],
+        )
+
+    def test_keep_more_than_exist(self):
+        self.assertEqual(select_superseded_release_branches(self.branch_names, "portal", 5), [])
+
+    def test_invalid_keep_last(self):
+        with self.assertRaises(ValueError):
+            select_superseded_release_branches(self.branch_names, "portal", 0)
+
+
+class FakeGitOutput:
+    """
+    Stands in for run_git_output, answering each git plumbing command and recording what it was given.
+    """
+    def __init__(self, manifest=None):
+        self.manifest = manifest
+        self.calls = []
+
+    def __call__(self, args, input_text=None):
+        self.calls.append((args, input_text))
+        command = args[1]
+        if command == "show":
+            return json.dumps(self.manifest)
+        if command == "hash-object":
+            return "blobsha\n"
+        if command == "mktree":
+            return "treesha\n"
+        if command == "commit-tree":
+            return "archivecommitsha\n"
+        raise AssertionError(f"Unexpected git command {args}")
+
+    def input_for(self, command):
+        return next(input_text for args, input_text in self.calls if args[1] == command)
+
+    def args_for(self, command):
+        return next(args for args, _ in self.calls if args[1] == command)
+
+
+class TestReleaseArchiveManifest(unittest.TestCase):
+    @patch("scripts.scripted_release.scripted_release_utils.run_git_output")
+    def test_read_manifest_without_archive_branch(self, run_git_output):
+        self.assertEqual(read_release_archive_manifest(None), {})
+        run_git_output.assert_not_called()
+
+    def test_read_manifest(self):
+        fake_git = FakeGitOutput(manifest={"portal": {"refs/tags/portal/v1.0.0-rc1": "aaa"}})
+        with patch("scripts.scripted_release.scripted_release_utils.run_git_output", fake_git):
+            manifest = read_release_archive_manifest("oldarchivesha")
+
+        self.assertEqual(manifest, {"portal": {"refs/tags/portal/v1.0.0-rc1": "aaa"}})
+        self.assertEqual(fake_git.calls[0][0], ["git", "show", "oldarchivesha:release_archive.json"])
+
+    def test_commit_manifest_keeps_archived_commits_as_parents(self):
+        fake_git = FakeGitOutput()
+        with patch("scripts.scripted_release.scripted_release_utils.run_git_output", fake_git):
+            commit_sha = commit_release_archive_manifest(
+                {"portal": {}}, "oldarchivesha", ["bbb", "aaa", "bbb"], "Archive 'portal' refs"
+            )
+
+        self.assertEqual(commit_sha, "archivecommitsha")
+        self.assertEqual(fake_git.input_for("mktree"), "100644 blob blobsha\trelease_archive.json\n")
+        self.assertEqual(
+            fake_git.args_for("commit-tree"),
+            ["git", "commit-tree", "treesha", "-p", "oldarchivesha", "-p", "aaa", "-p", "bbb", "-F", "-"],
+        )
+        # The message goes in on stdin so quotes in it cannot break the command
+        self.assertEqual(fake_git.input_for("commit-tree"), "Archive 'portal' refs")
+
+
+@patch("scripts.scripted_release.scripted_release_utils.run_git_command")
+class TestArchiveAndDeleteRefs(unittest.TestCase):
+    def setUp(self):
+        self.refs_to_prune = {
+            "refs/tags/portal/v1.0.0-rc2": "bbb",
+            "refs/heads/release/portal/v1.0.0": "aaa",
+        }
+
+    def test_first_archive(self, run_git_command):
+        fake_git = FakeGitOutput()
+        with patch("scripts.scripted_release.scripted_release_utils.run_git_output", fake_git):
+            archive_and_delete_refs("portal", self.refs_to_prune, None)
+
+        self.assertEqual(json.loads(fake_git.input_for("hash-object")), {"portal": self.refs_to_prune})
+        # Without an archive branch the archive commit's only parents are the pruned commits
+        self.assertEqual(
+            fake_git.args_for("commit-tree"),
+            ["git", "commit-tree", "treesha", "-p", "aaa", "-p", "bbb", "-F", "-"],
+        )
+        run_git_command.assert_any_call(
+            "git fetch origin refs/heads/release/portal/v1.0.0 refs/tags/portal/v1.0.0-rc2"
+        )
+        self.assertEqual(
+            run_git_command.call_args_list[-1][0][0],
+            "git push --atomic origin archivecommitsha:refs/heads/release-archive "
+            ":refs/heads/release/portal/v1.0.0 :refs/tags/portal/v1.0.0-rc2",
+        )
+
+    def test_archive_merges_into_existing_manifest(self, run_git_command):
+        fake_git = FakeGitOutput(
+            manifest={
+                "portal": {"refs/tags/portal/v0.9.0-rc1": "old"},
+                "other": {"refs/tags/other/v1.0.0-rc1": "otherold"},
+            }
+        )
+        with patch("scripts.scripted_release.scripted_release_utils.run_git_output", fake_git):
+            archive_and_delete_refs("portal", self.refs_to_prune, "oldarchivesha")
+
+        self.assertEqual(
+            json.loads(fake_git.input_for("hash-object")),
+            {
+                "portal": {"refs/tags/portal/v0.9.0-rc1": "old", **self.refs_to_prune},
+                "other": {"refs/tags/other/v1.0.0-rc1": "otherold"},
+            },
+        )
+        self.assertEqual(
+            fake_git.args_for("commit-tree"),
+            ["git", "commit-tree", "treesha", "-p", "oldarchivesha", "-p", "aaa", "-p", "bbb", "-F", "-"],
+        )
+        run_git_command.assert_any_call(
+            "git fetch origin refs/heads/release/portal/v1.0.0 refs/tags/portal/v1.0.0-rc2 "
+            "refs/heads/release-archive"
+        )
+        self.assertEqual(
+            run_git_command.call_args_list[-1][0][0],
+            "git push --atomic origin archivecommitsha:refs/heads/release-archive "
+            ":refs/heads/release/portal/v1.0.0 :refs/tags/portal/v1.0.0-rc2",
+        )
+
+    @patch("scripts.scripted_release.scripted_release_utils.run_git_output")
+    def test_nothing_to_prune(self, run_git_output, run_git_command):
+        archive_and_delete_refs("portal", {}, "oldarchivesha")
+
+        run_git_output.assert_not_called()
+        run_git_command.assert_not_called()
+
+
 if __name__ == "__main__":
     unittest.main()